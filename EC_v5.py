@@ -1,23 +1,135 @@
+import asyncio
+import hashlib
+import itertools
 import json
 import ollama
-import time
-import re
-from typing import List, Dict, Any
+import orjson
+import os
+import sqlite3
+from collections import Counter, deque
+from contextlib import asynccontextmanager, nullcontext
+from functools import lru_cache
+from typing import BinaryIO, Iterable, List, Dict, Any, Optional, Tuple
+
+# 客户端并发数，应与服务端的 OLLAMA_NUM_PARALLEL 并行槽位数保持一致
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4"))
+
+_JSON_DECODER = json.JSONDecoder()
+
+# 常见的情感指示词（小写字面量），按顺序匹配
+_EMOTION_PATTERNS = {
+    "Delight": ["delight", "happy", "joy", "pleasure"],
+    "Anger": ["anger", "angry", "mad", "furious"],
+    "Embarrassment": ["embarrassment", "embarrassed", "ashamed", "shame"],
+    "Hopeless": ["hopeless", "despair", "desperate", "no hope"],
+    "Pride": ["pride", "proud", "accomplish", "achievement"],
+    "Disappointment": ["disappointment", "disappointed", "let down", "dissatisfied"]
+}
+
+@lru_cache(maxsize=64)
+def _choice_lookup(choices: Tuple[str, ...]) -> Dict[str, str]:
+    """
+    小写选项到原始选项的映射，按选项顺序排列，重复时保留靠前的选项；
+    数据集中的选项组合很少，同一组只计算一次
+    """
+    lookup = {}
+    for choice in choices:
+        lookup.setdefault(choice.lower(), choice)
+    return lookup
+
+# 提示词中与样例无关的结尾部分
+_PROMPT_FOOTER = """
+Only return the selected label in the output, without any additional content.
+You MUST select one emotion from the provided choices.
+Please provide your answer in a structured JSON format as follows: 
+{"Emotion": "selected_emotion"}
+"""
 
 class OllamaJSONLProcessor:
-    def __init__(self, model_name: str, base_prompt: str):
+    def __init__(self, model_name: str, base_prompt: str, concurrency: int = OLLAMA_NUM_PARALLEL,
+                 cache_file: Optional[str] = None, host: Optional[str] = None):
         """
         初始化处理器
         
         Args:
             model_name: Ollama中的模型名称
             base_prompt: 整体的基础提示词
+            concurrency: 同时发往Ollama的最大请求数
+            cache_file: 模型回答缓存文件路径，None表示不缓存（缓存键不含模型版本，重建同名模型后需删除旧缓存）
+            host: Ollama服务器URL，None表示使用 OLLAMA_HOST 或默认地址
         """
         self.model_name = model_name
         self.base_prompt = base_prompt
-        self.results = []
+        self.concurrency = concurrency
+        
+        # 提示词中与样例无关的开头部分只拼接一次
+        self._prompt_header = f"\n{base_prompt}\n\nScenario:\n"
+        
+        # 客户端和信号量绑定事件循环，由 _ollama_session 按需创建，同一次运行的请求共用连接池
+        self._host = host
+        self._client = None
+        self._semaphore = None
+        self._session_users = 0
+        
+        # 摘要统计随结果增量更新，无需保留全部结果
+        self._n_total = 0
+        self._emotion_counts = Counter()
+        
+        # 按提示词缓存模型回答，重复样例或中断后重跑时无需再次调用模型
+        self._cache = None
+        if cache_file:
+            self._cache = sqlite3.connect(cache_file)
+            self._cache.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT)")
+    
+    def close(self):
+        """关闭缓存数据库"""
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
     
-    def extract_emotion_from_json(self, model_response: str) -> str:
+    @asynccontextmanager
+    async def _ollama_session(self):
+        """
+        在当前事件循环中准备客户端和信号量
+        
+        嵌套或并发调用共用同一组对象，最后一个使用者退出时关闭客户端，下次运行重新创建。
+        """
+        if self._session_users == 0:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._client = ollama.AsyncClient(host=self._host)
+        self._session_users += 1
+        try:
+            yield
+        finally:
+            self._session_users -= 1
+            if self._session_users == 0:
+                client, self._client, self._semaphore = self._client, None, None
+                await client.close()
+    
+    def _cache_key(self, prompt: str) -> str:
+        """模型名与提示词共同决定缓存键"""
+        return hashlib.blake2b(f"{self.model_name}\0{prompt}".encode(), digest_size=16).hexdigest()
+    
+    def _get_cached_response(self, key: str) -> Optional[str]:
+        if self._cache is None:
+            return None
+        row = self._cache.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+    
+    def _set_cached_response(self, key: str, response: str):
+        if self._cache is None:
+            return
+        with self._cache:
+            self._cache.execute("INSERT OR REPLACE INTO responses (key, response) VALUES (?, ?)", (key, response))
+    
+    @staticmethod
+    def extract_emotion_from_json(model_response: str) -> str:
         """
         从模型回答的JSON格式中提取情感
         
@@ -27,15 +139,16 @@ class OllamaJSONLProcessor:
         Returns:
             提取出的情感，如果无法提取则返回None
         """
-        try:
-            # 尝试从响应中提取JSON部分
-            json_match = re.search(r'\{[^{}]*"Emotion"[^{}]*\}', model_response)
-            if json_match:
-                json_str = json_match.group()
-                emotion_data = json.loads(json_str)
-                return emotion_data.get("Emotion")
-        except:
-            pass
+        # 从每个 '{' 处尝试直接解码JSON对象，找到含Emotion字段的即返回
+        idx = model_response.find('{')
+        while idx != -1:
+            try:
+                emotion_data, _ = _JSON_DECODER.raw_decode(model_response, idx)
+                if "Emotion" in emotion_data:
+                    return emotion_data["Emotion"]
+            except json.JSONDecodeError:
+                pass
+            idx = model_response.find('{', idx + 1)
         return None
     
     def extract_emotion(self, model_response: str, choices: List[str]) -> str:
@@ -49,42 +162,42 @@ class OllamaJSONLProcessor:
         Returns:
             提取出的情感，强制从选项中选择一个
         """
-        # 首先尝试从JSON格式中提取
-        emotion_from_json = self.extract_emotion_from_json(model_response)
+        return self._extract_emotion(model_response, tuple(choices))
+    
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _extract_emotion(model_response: str, choices: Tuple[str, ...]) -> str:
+        """extract_emotion 的实现，按回答文本和选项缓存结果"""
+        # 模型只返回了选项本身（可能带引号或括号）时直接查表
+        bare = model_response.strip(' \t\r\n"\'{}.').lower()
+        choice = _choice_lookup(choices).get(bare)
+        if choice is not None:
+            return choice
+        
+        # 尝试从JSON格式中提取
+        emotion_from_json = OllamaJSONLProcessor.extract_emotion_from_json(model_response)
         if emotion_from_json and emotion_from_json in choices:
             return emotion_from_json
         
         # 将模型回答转换为小写以便匹配
         response_lower = model_response.lower()
         
-        # 将选项也转换为小写
-        choices_lower = [choice.lower() for choice in choices]
+        # 尝试在回答中直接找到选项中的情感词，返回原始大小写的选项
+        for choice_lower, choice in _choice_lookup(choices).items():
+            if choice_lower in response_lower:
+                return choice
         
-        # 尝试在回答中直接找到选项中的情感词
-        for i, choice in enumerate(choices_lower):
-            if choice in response_lower:
-                return choices[i]  # 返回原始大小写的选项
-        
-        # 如果直接匹配失败，尝试查找常见的情感指示词
-        emotion_patterns = {
-            "Delight": [r"delight", r"happy", r"joy", r"pleasure"],
-            "Anger": [r"anger", r"angry", r"mad", r"furious"],
-            "Embarrassment": [r"embarrassment", r"embarrassed", r"ashamed", r"shame"],
-            "Hopeless": [r"hopeless", r"despair", r"desperate", r"no hope"],
-            "Pride": [r"pride", r"proud", r"accomplish", r"achievement"],
-            "Disappointment": [r"disappointment", r"disappointed", r"let down", r"dissatisfied"]
-        }
-        
-        for emotion, patterns in emotion_patterns.items():
+        # 如果直接匹配失败，尝试查找常见的情感指示词；指示词均为字面量，直接子串查找即可
+        for emotion, keywords in _EMOTION_PATTERNS.items():
             if emotion in choices:  # 只检查在选项中的情感
-                for pattern in patterns:
-                    if re.search(pattern, response_lower):
+                for keyword in keywords:
+                    if keyword in response_lower:
                         return emotion
         
         # 如果还是找不到，选择第一个选项作为默认
         return choices[0] if choices else "Delight"
     
-    def process_single_example(self, example: Dict[str, Any]) -> Dict[str, Any]:
+    async def process_single_example(self, example: Dict[str, Any]) -> Dict[str, Any]:
         """
         处理单个测试样例
         
@@ -99,29 +212,28 @@ class OllamaJSONLProcessor:
         subject = example.get("Subject", "")
         choices = example.get("choices", [])
         
-        full_prompt = f"""
-{self.base_prompt}
-
-Scenario:
-{context}
-
-Question: What emotion(s) would {subject} ultimately feel in this situation?
-Choices: {', '.join(choices)}
-
-Only return the selected label in the output, without any additional content.
-You MUST select one emotion from the provided choices.
-Please provide your answer in a structured JSON format as follows: 
-{{"Emotion": "selected_emotion"}}
-"""
+        full_prompt = (
+            f"{self._prompt_header}{context}\n\n"
+            f"Question: What emotion(s) would {subject} ultimately feel in this situation?\n"
+            f"Choices: {', '.join(choices)}\n"
+            f"{_PROMPT_FOOTER}"
+        )
         try:
-            # 调用Ollama模型
-            response = ollama.generate(
-                model=self.model_name,
-                prompt=full_prompt
-            )
+            # 命中缓存则跳过模型调用
+            cache_key = self._cache_key(full_prompt)
+            model_response = self._get_cached_response(cache_key)
             
-            # 提取模型回答
-            model_response = response['response']
+            if model_response is None:
+                # 调用Ollama模型，信号量限制同时在途的请求数
+                async with self._ollama_session(), self._semaphore:
+                    response = await self._client.generate(
+                        model=self.model_name,
+                        prompt=full_prompt
+                    )
+                
+                # 提取模型回答
+                model_response = response['response']
+                self._set_cached_response(cache_key, model_response)
             
             # 从模型回答中提取情感
             predicted_emotion = self.extract_emotion(model_response, choices)
@@ -144,79 +256,96 @@ Please provide your answer in a structured JSON format as follows:
                 "predicted_emotion": default_emotion
             }
     
-    def process_jsonl_file(self, input_file: str, output_file: str = None, delay: float = 1.0, max_examples: int = None):
+    def process_jsonl_file(self, input_file: str, output_file: str = None, max_examples: int = None):
         """
         处理整个JSONL文件
         
         Args:
             input_file: 输入JSONL文件路径
             output_file: 输出结果文件路径（可选）
-            delay: 每次API调用之间的延迟（秒）
             max_examples: 最大处理样例数（可选）
         """
         print(f"开始处理文件: {input_file}")
         print(f"使用模型: {self.model_name}")
+        print(f"并发请求数: {self.concurrency}")
         
-        # 读取JSONL文件
-        with open(input_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        
-        # 限制处理数量
         if max_examples:
-            lines = lines[:max_examples]
             print(f"测试模式: 只处理前 {max_examples} 个样例")
         
-        total_examples = len(lines)
-        print(f"找到 {total_examples} 个测试样例")
+        # 逐行读取JSONL文件，读到即提交，无需先把整个文件载入内存；
+        # 每完成一个样例立即写入输出文件，中途中断也不会丢失已完成的结果
+        with open(input_file, 'rb') as f, \
+             (open(output_file, 'wb') if output_file else nullcontext()) as out:
+            lines = itertools.islice(f, max_examples) if max_examples else f
+            asyncio.run(self._process_lines(lines, out))
         
-        # 处理每个样例
-        for i, line in enumerate(lines):
-            try:
-                example = json.loads(line.strip())
-                print(f"处理样例 {i+1}/{total_examples} (ID: {example.get('id')})...")
-                
-                result = self.process_single_example(example)
-                self.results.append(result)
-                
-                # 显示进度
-                print(f"✓ 完成样例 {example.get('id')}: {result.get('predicted_emotion')}")
-                
-                # 添加延迟以避免过快的API调用
-                if i < total_examples - 1:  # 不在最后一个样例后等待
-                    time.sleep(delay)
-                    
-            except json.JSONDecodeError as e:
-                print(f"❌ 解析第 {i+1} 行JSON时出错: {str(e)}")
-                self.results.append({
-                    "id": i,
-                    "predicted_emotion": "Delight"  # 默认情感
-                })
-            except Exception as e:
-                print(f"❌ 处理第 {i+1} 行时出错: {str(e)}")
-                self.results.append({
-                    "id": i,
-                    "predicted_emotion": "Delight"  # 默认情感
-                })
-        
-        # 保存结果
         if output_file:
-            self.save_results(output_file)
+            print(f"结果已保存到: {output_file}")
+            self.preview_results(output_file)
         
-        print(f"处理完成！共处理 {len(self.results)} 个样例")
+        print(f"处理完成！共处理 {self._n_total} 个样例")
     
-    def save_results(self, output_file: str):
-        """保存结果到文件，确保格式为指定的JSONL格式"""
-        with open(output_file, 'w', encoding='utf-8') as f:
-            for result in self.results:
-                # 只包含id和predicted_emotion两个字段
-                output_item = {
-                    "id": result.get("id"),
-                    "predicted_emotion": result.get("predicted_emotion")
-                }
-                f.write(json.dumps(output_item, ensure_ascii=False) + '\n')
-        print(f"结果已保存到: {output_file}")
+    async def _process_lines(self, lines: Iterable[bytes], out: Optional[BinaryIO]):
+        """
+        并发处理所有行，结果按输入顺序计入统计并写入输出文件
+        
+        在途任务数限制在并发数的两倍以内，内存占用与文件大小无关。
+        """
+        window = 2 * self.concurrency
+        pending = deque()
         
-        # 显示输出文件的前几行作为验证
+        # 整次运行共用一个客户端连接池
+        async with self._ollama_session():
+            for i, line in enumerate(lines):
+                pending.append(asyncio.create_task(self._process_line(i, line)))
+                if len(pending) >= window:
+                    self._collect_result(await pending.popleft(), out)
+            
+            while pending:
+                self._collect_result(await pending.popleft(), out)
+    
+    def _collect_result(self, result: Dict[str, Any], out: Optional[BinaryIO]):
+        """记录一条已完成的结果"""
+        self._n_total += 1
+        emotion = result.get("predicted_emotion")
+        if emotion:
+            self._emotion_counts[emotion] += 1
+        if out is not None:
+            self.save_result(out, result)
+    
+    async def _process_line(self, i: int, line: bytes) -> Dict[str, Any]:
+        """解析并处理单行样例"""
+        try:
+            example = orjson.loads(line)
+            print(f"处理样例 {i+1} (ID: {example.get('id')})...")
+            
+            result = await self.process_single_example(example)
+            
+            # 显示进度
+            print(f"✓ 完成样例 {example.get('id')}: {result.get('predicted_emotion')}")
+            return result
+            
+        except orjson.JSONDecodeError as e:
+            print(f"❌ 解析第 {i+1} 行JSON时出错: {str(e)}")
+        except Exception as e:
+            print(f"❌ 处理第 {i+1} 行时出错: {str(e)}")
+        return {
+            "id": i,
+            "predicted_emotion": "Delight"  # 默认情感
+        }
+    
+    def save_result(self, out: BinaryIO, result: Dict[str, Any]):
+        """写入单条结果并立即刷新，确保格式为指定的JSONL格式"""
+        # 只包含id和predicted_emotion两个字段
+        output_item = {
+            "id": result.get("id"),
+            "predicted_emotion": result.get("predicted_emotion")
+        }
+        out.write(orjson.dumps(output_item) + b'\n')
+        out.flush()
+    
+    def preview_results(self, output_file: str):
+        """显示输出文件的前几行作为验证"""
         print("\n输出文件前几行预览:")
         with open(output_file, 'r', encoding='utf-8') as f:
             for i, line in enumerate(f):
@@ -227,26 +356,20 @@ Please provide your answer in a structured JSON format as follows:
     
     def print_summary(self):
         """打印处理摘要"""
-        successful = len([r for r in self.results if r.get("predicted_emotion")])
-        failed = len([r for r in self.results if not r.get("predicted_emotion")])
+        successful = sum(self._emotion_counts.values())
+        failed = self._n_total - successful
         
         print("\n" + "="*50)
         print("处理摘要")
         print("="*50)
-        print(f"总样例数: {len(self.results)}")
+        print(f"总样例数: {self._n_total}")
         print(f"成功: {successful}")
         print(f"失败: {failed}")
         print(f"使用模型: {self.model_name}")
         
         # 显示情感分布
-        emotion_counts = {}
-        for result in self.results:
-            emotion = result.get("predicted_emotion")
-            if emotion:
-                emotion_counts[emotion] = emotion_counts.get(emotion, 0) + 1
-        
         print("\n情感分布:")
-        for emotion, count in emotion_counts.items():
+        for emotion, count in self._emotion_counts.items():
             print(f"  {emotion}: {count}")
 
 def main():
@@ -254,6 +377,7 @@ def main():
     MODEL_NAME = "testclassifi"  # 替换为您想要使用的Ollama模型
     INPUT_FILE = "Emotion_Classification.jsonl"  # 输入文件路径
     OUTPUT_FILE = "ECresults.jsonl"  # 输出文件路径
+    CACHE_FILE = ".ollama_cache.db"  # 模型回答缓存文件路径（启用缓存时使用）
     
     # 基础提示词 - 英文版本，针对情感分析任务定制
     BASE_PROMPT = """
@@ -317,22 +441,24 @@ Focus specifically on the emotional state of the subject character in the given
         print("\n运行完整数据集处理模式...")
         max_examples = None  # 处理所有样例
     
+    # 缓存默认关闭，避免重建同名模型后读到旧回答
+    use_cache = input("是否启用模型回答缓存 (y/N): ").strip().lower() == "y"
+    
     # 创建处理器
-    processor = OllamaJSONLProcessor(
+    with OllamaJSONLProcessor(
         model_name=MODEL_NAME,
-        base_prompt=BASE_PROMPT
-    )
-
-    # 处理文件
-    processor.process_jsonl_file(
-        input_file=INPUT_FILE,
-        output_file=OUTPUT_FILE,
-        delay=2.0,  # 每次调用间隔2秒
-        max_examples=max_examples
-    )
+        base_prompt=BASE_PROMPT,
+        cache_file=CACHE_FILE if use_cache else None
+    ) as processor:
+        # 处理文件
+        processor.process_jsonl_file(
+            input_file=INPUT_FILE,
+            output_file=OUTPUT_FILE,
+            max_examples=max_examples
+        )
 
-    # 显示摘要
-    processor.print_summary()
+        # 显示摘要
+        processor.print_summary()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,62 +1,53 @@
 import json
-import requests
-import time
-from typing import List, Dict, Any
-import logging
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterator, List, Dict, Any, Tuple
 import re
+from base import OLLAMA_NUM_PARALLEL, OllamaSessionProcessor
 
-class OllamaEmotionProcessor:
-    def __init__(self, base_url: str = "http://localhost:11434", model: str = "llama2"):
+_JSON_DECODER = json.JSONDecoder()
+
+# 手动提取索引时依次尝试的模式
+_INDEX_PATTERNS = [
+    re.compile(p, re.IGNORECASE) for p in [
+        r'"index"\s*:\s*(\d+)',
+        r'index\s*:\s*(\d+)',
+        r'不一致.*?(\d+)',
+        r'inconsistent.*?(\d+)',
+        r'index\s*=\s*(\d+)'
+    ]
+]
+
+_NUMBER_RE = re.compile(r'\b\d+\b')
+
+_PROMPT_TEMPLATE = """There are {num_texts} texts in the text list.
+
+Text list:
+{texts_str}
+
+Please identify the text that has an inconsistent emotion compared to the others and provide its index.
+
+Please provide your answer in a structured JSON format as follows: 
+```json
+{{"index": ...}}
+```"""
+
+class OllamaEmotionProcessor(OllamaSessionProcessor):
+    def __init__(self, base_url: str = "http://localhost:11434", model: str = "llama2",
+                 batch_size: int = OLLAMA_NUM_PARALLEL):
         """
         初始化Ollama处理器
-        """
-        self.base_url = base_url
-        self.model = model
-        self.generate_url = f"{base_url}/api/generate"
         
-        # 设置日志
-        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-        self.logger = logging.getLogger(__name__)
-    
-    def check_ollama_connection(self) -> bool:
-        """检查Ollama连接是否正常"""
-        try:
-            response = requests.get(f"{self.base_url}/api/tags", timeout=10)
-            return response.status_code == 200
-        except Exception as e:
-            self.logger.error(f"连接Ollama失败: {e}")
-            return False
-    
-    def generate_response(self, prompt: str, max_retries: int = 3) -> str:
-        """
-        使用Ollama生成回复
+        Args:
+            base_url: Ollama服务器URL
+            model: 模型名称
+            batch_size: 每批并发提交的请求数
         """
-        payload = {
-            "model": self.model,
-            "prompt": prompt,
-            "stream": False
-        }
-        
-        for attempt in range(max_retries):
-            try:
-                response = requests.post(self.generate_url, json=payload, timeout=120)
-                response.raise_for_status()
-                
-                result = response.json()
-                return result.get("response", "").strip()
-                
-            except requests.exceptions.RequestException as e:
-                self.logger.warning(f"第 {attempt + 1} 次请求失败: {e}")
-                if attempt < max_retries - 1:
-                    time.sleep(2)
-                else:
-                    self.logger.error(f"所有重试均失败: {e}")
-                    return ""
-            except json.JSONDecodeError as e:
-                self.logger.error(f"JSON解析错误: {e}")
-                return ""
-        
-        return ""
+        # 连接数需覆盖一个批次的并发请求
+        super().__init__(base_url, model, pool_size=batch_size)
+        self.batch_size = batch_size
+        self.processed_count = 0
+        self.error_count = 0
     
     def extract_index_from_response(self, response_text: str) -> int:
         """
@@ -66,38 +57,28 @@ class OllamaEmotionProcessor:
             self.logger.warning("模型返回空响应")
             return -1
         
-        # 尝试提取JSON格式的index
-        try:
-            # 查找JSON代码块
-            json_match = re.search(r'```json\s*(.*?)\s*```', response_text, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(1)
-                data = json.loads(json_str)
-                return data.get("index", -1)
-            else:
-                # 如果没有代码块标记，尝试直接解析整个响应
-                data = json.loads(response_text)
-                return data.get("index", -1)
-        except json.JSONDecodeError:
-            # 如果JSON解析失败，尝试直接提取数字
-            self.logger.warning("JSON解析失败，尝试直接提取数字")
-            return self._extract_index_manually(response_text)
+        # 从每个 '{' 处尝试直接解码JSON对象，代码块与裸JSON均适用
+        idx = response_text.find('{')
+        while idx != -1:
+            try:
+                data, _ = _JSON_DECODER.raw_decode(response_text, idx)
+                if "index" in data:
+                    return data["index"]
+            except json.JSONDecodeError:
+                pass
+            idx = response_text.find('{', idx + 1)
+        
+        # 如果JSON解析失败，尝试直接提取数字
+        self.logger.warning("JSON解析失败，尝试直接提取数字")
+        return self._extract_index_manually(response_text)
     
     def _extract_index_manually(self, text: str) -> int:
         """
         手动从文本中提取索引值
         """
         # 尝试匹配数字
-        patterns = [
-            r'"index"\s*:\s*(\d+)',
-            r'index\s*:\s*(\d+)',
-            r'不一致.*?(\d+)',
-            r'inconsistent.*?(\d+)',
-            r'index\s*=\s*(\d+)'
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
+        for pattern in _INDEX_PATTERNS:
+            match = pattern.search(text)
             if match:
                 try:
                     return int(match.group(1))
@@ -105,7 +86,7 @@ class OllamaEmotionProcessor:
                     continue
         
         # 如果找不到明确的数字，尝试提取第一个数字
-        numbers = re.findall(r'\b\d+\b', text)
+        numbers = _NUMBER_RE.findall(text)
         if numbers:
             try:
                 return int(numbers[0])
@@ -121,29 +102,14 @@ class OllamaEmotionProcessor:
         """
         # 提取文本列表
         texts = case_data.get("text", [])
-        num_texts = len(texts)
         
         # 构建文本列表字符串
-        texts_str = ""
-        for item in texts:
-            index = item.get("index", -1)
-            context = item.get("context", "")
-            texts_str += f"Index {index}: {context}\n\n"
+        texts_str = "".join(
+            f"Index {item.get('index', -1)}: {item.get('context', '')}\n\n" for item in texts
+        )
         
         # 构建完整提示词
-        prompt = f"""There are {num_texts} texts in the text list.
-
-Text list:
-{texts_str}
-
-Please identify the text that has an inconsistent emotion compared to the others and provide its index.
-
-Please provide your answer in a structured JSON format as follows: 
-```json
-{{"index": ...}}
-```"""
-        
-        return prompt
+        return _PROMPT_TEMPLATE.format(num_texts=len(texts), texts_str=texts_str)
     
     def process_single_case(self, case_data: Dict[str, Any], case_id: int) -> Dict[str, Any]:
         """
@@ -176,6 +142,10 @@ Please provide your answer in a structured JSON format as follows:
         """
         处理整个JSONL文件
         
+        每批 batch_size 个请求同时提交，由服务端合并为一次批处理前向计算。
+        服务端需设置 OLLAMA_NUM_PARALLEL 不小于 batch_size，
+        并通过 OLLAMA_MAX_LOADED_MODELS 避免模型被换出。
+        
         Args:
             input_file: 输入JSONL文件路径
             output_file: 输出JSONL文件路径
@@ -188,52 +158,89 @@ Please provide your answer in a structured JSON format as follows:
         
         self.logger.info(f"开始处理文件: {input_file}")
         self.logger.info(f"使用模型: {self.model}")
+        self.logger.info(f"批大小: {self.batch_size}")
         if max_lines:
             self.logger.info(f"最大处理行数: {max_lines}")
         
-        processed_count = 0
-        error_count = 0
+        self.processed_count = 0
+        self.error_count = 0
         
-        with open(input_file, 'r', encoding='utf-8') as infile, \
-             open(output_file, 'w', encoding='utf-8') as outfile:
+        with open(input_file, 'rb') as infile, \
+             open(output_file, 'wb') as outfile, \
+             ThreadPoolExecutor(max_workers=self.batch_size) as executor:
             
-            for line_num, line in enumerate(infile, 1):
-                if max_lines and line_num > max_lines:
-                    self.logger.info(f"达到最大行数限制 {max_lines}，停止处理")
-                    break
-                    
-                line = line.strip()
-                if not line:
-                    continue
+            # 凑满一批即提交
+            batch = []
+            for record in self._iter_records(infile, max_lines):
+                batch.append(record)
+                if len(batch) == self.batch_size:
+                    self._process_batch(batch, executor, outfile)
+                    batch = []
+            
+            if batch:
+                self._process_batch(batch, executor, outfile)
+        
+        self.logger.info(f"处理完成! 成功: {self.processed_count}, 失败: {self.error_count}")
+    
+    def _iter_records(self, infile: BinaryIO, max_lines: int = None) -> Iterator[Tuple[int, int, str]]:
+        """
+        逐行解析输入并构建提示词，格式错误的行记录日志后跳过
+        
+        Yields:
+            (行号, 用例ID, 提示词)
+        """
+        for line_num, line in enumerate(infile, 1):
+            if max_lines and line_num > max_lines:
+                self.logger.info(f"达到最大行数限制 {max_lines}，停止处理")
+                return
                 
-                try:
-                    # 解析JSON
-                    case_data = json.loads(line)
-                    
-                    # 使用行号作为ID（从0开始）
-                    case_id = line_num - 1
-                    
-                    # 处理单个用例
-                    result = self.process_single_case(case_data, case_id)
-                    
-                    # 写入结果（严格符合要求格式）
-                    outfile.write(json.dumps(result, ensure_ascii=False) + '\n')
-                    outfile.flush()
-                    
-                    processed_count += 1
-                    self.logger.info(f"成功处理第 {line_num} 行，ID: {case_id}, 预测索引: {result['predicted_index']}")
-                    
-                    # 添加延迟避免过载
-                    time.sleep(1)
-                    
-                except json.JSONDecodeError as e:
-                    self.logger.error(f"第 {line_num} 行JSON解析错误: {e}")
-                    error_count += 1
-                except Exception as e:
-                    self.logger.error(f"处理第 {line_num} 行时发生错误: {e}")
-                    error_count += 1
+            if line.isspace():
+                continue
+            
+            try:
+                # 解析JSON
+                case_data = orjson.loads(line)
+                prompt = self.build_prompt(case_data)
+            except orjson.JSONDecodeError as e:
+                self.logger.error(f"第 {line_num} 行JSON解析错误: {e}")
+                self.error_count += 1
+                continue
+            except Exception as e:
+                self.logger.error(f"处理第 {line_num} 行时发生错误: {e}")
+                self.error_count += 1
+                continue
+            
+            # 使用行号作为ID（从0开始）
+            yield line_num, line_num - 1, prompt
+    
+    def _process_batch(self, batch: List[Tuple[int, int, str]], executor: ThreadPoolExecutor, outfile: BinaryIO):
+        """
+        并发提交一批提示词，并按原始顺序一次性写入整批结果
+        """
+        output_lines = []
+        
+        # 同一批次的请求并发提交，结果按原始顺序取回，单个请求出错只影响对应行
+        futures = [executor.submit(self.generate_response, prompt) for _, _, prompt in batch]
         
-        self.logger.info(f"处理完成! 成功: {processed_count}, 失败: {error_count}")
+        for (line_num, case_id, _), future in zip(batch, futures):
+            try:
+                # 构建最终输出格式
+                result = {
+                    "id": case_id,
+                    "predicted_index": self.extract_index_from_response(future.result())
+                }
+                output_lines.append(orjson.dumps(result) + b'\n')
+                
+                self.processed_count += 1
+                self.logger.info(f"成功处理第 {line_num} 行，ID: {case_id}, 预测索引: {result['predicted_index']}")
+                
+            except Exception as e:
+                self.logger.error(f"处理第 {line_num} 行时发生错误: {e}")
+                self.error_count += 1
+        
+        # 整批结果合并为一次写入（严格符合要求格式）
+        outfile.write(b''.join(output_lines))
+        outfile.flush()
 
 def main():
     """主函数"""
@@ -245,23 +252,25 @@ def main():
     parser.add_argument('--output', '-o', required=True, help='输出JSONL文件路径')
     parser.add_argument('--model', '-m', default='llama2', help='Ollama模型名称 (默认: llama2)')
     parser.add_argument('--url', '-u', default='http://localhost:11434', help='Ollama服务器URL')
+    parser.add_argument('--batch-size', '-b', type=int, default=OLLAMA_NUM_PARALLEL,
+                        help=f'每批并发请求数，应与服务端 OLLAMA_NUM_PARALLEL 一致 (默认: {OLLAMA_NUM_PARALLEL})')
     parser.add_argument('--test', '-t', action='store_true', help='测试模式：只处理前3条数据')
     
     args = parser.parse_args()
     
     # 初始化处理器
-    processor = OllamaEmotionProcessor(
+    with OllamaEmotionProcessor(
         base_url=args.url,
-        model=args.model
-    )
-    
-    # 处理文件
-    if args.test:
-        print("测试模式：只处理前3条数据")
-        processor.process_jsonl_file(args.input, args.output, max_lines=3)
-    else:
-        print("完整模式：处理所有数据")
-        processor.process_jsonl_file(args.input, args.output)
+        model=args.model,
+        batch_size=args.batch_size
+    ) as processor:
+        # 处理文件
+        if args.test:
+            print("测试模式：只处理前3条数据")
+            processor.process_jsonl_file(args.input, args.output, max_lines=3)
+        else:
+            print("完整模式：处理所有数据")
+            processor.process_jsonl_file(args.input, args.output)
     
     print(f"\n处理完成！结果保存在: {args.output}")
     
@@ -1,115 +1,149 @@
+import asyncio
 import json
-import requests
+import orjson
+import os
 import time
-from typing import List, Dict, Any
-import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import BinaryIO, List, Dict, Any, Optional, Set, Tuple
 import re
+from base import OLLAMA_NUM_PARALLEL, OllamaSessionProcessor, RequestRateLimiter
 
-class OllamaJSONLProcessor:
-    def __init__(self, base_url: str = "http://localhost:11434", model: str = "llama2"):
+# 逐行的处理日志只在DEBUG级别输出，INFO级别每处理这么多个用例汇报一次进度
+PROGRESS_EVERY = 100
+
+_JSON_DECODER = json.JSONDecoder()
+
+_PROMPT_TEMPLATE = """你是一名心理咨询专家。请基于以下心理咨询报告内容进行分析：
+
+案例描述: {case_desc_str}
+咨询过程: {consultation_str}
+经验与反思: {experience_and_reflection}
+
+请根据提供的内容总结以下信息：
+- 原因：个体心理问题的潜在或直接原因
+- 症状：个体表现出的自我报告或可观察的生理、心理或行为症状
+- 治疗过程：在咨询过程中应用的心理治疗方法、技术和阶段性干预
+- 疾病特征：心理问题的关键特征或发展模式
+- 治疗效果：治疗的影响或结果，包括个体状况的变化
+
+请严格按照以下JSON格式提供你的分析，不要添加任何其他文本：
+{{
+    "predicted_cause": "...",
+    "predicted_symptoms": "...", 
+    "predicted_treatment_process": "...",
+    "predicted_illness_Characteristics": "...",
+    "predicted_treatment_effect": "..."
+}}"""
+
+def _case_id(case_data: Dict[str, Any]) -> Any:
+    """输出结果与续跑判断共用的用例ID，没有ID的用例统一记为 unknown"""
+    return case_data.get("id", "unknown")
+
+def _join_text(value: Any) -> str:
+    """报告中的字段可能是句子列表，也可能已是字符串"""
+    return " ".join(value) if isinstance(value, list) else str(value)
+
+# 手动提取各字段时依次尝试的 (必需关键词, 模式)；
+# 文本（转小写后）不含关键词时该模式不可能匹配，直接跳过，省去一次全文扫描
+_FIELD_PATTERNS = {
+    field: [(keyword, re.compile(p, re.IGNORECASE | re.DOTALL)) for keyword, p in pattern_list]
+    for field, pattern_list in {
+        "predicted_cause": [
+            ('"predicted_cause"', r'"predicted_cause"\s*:\s*"([^"]*)"'),
+            ('cause', r'causes?["\']?\s*:\s*["\']?([^"\']*)')
+        ],
+        "predicted_symptoms": [
+            ('"predicted_symptoms"', r'"predicted_symptoms"\s*:\s*"([^"]*)"'),
+            ('symptom', r'symptoms?["\']?\s*:\s*["\']?([^"\']*)')
+        ],
+        "predicted_treatment_process": [
+            ('"predicted_treatment_process"', r'"predicted_treatment_process"\s*:\s*"([^"]*)"'),
+            ('treatment', r'treatment.process["\']?\s*:\s*["\']?([^"\']*)')
+        ],
+        "predicted_illness_Characteristics": [
+            ('"predicted_illness_characteristics"', r'"predicted_illness_Characteristics"\s*:\s*"([^"]*)"'),
+            ('characteristics', r'characteristics["\']?\s*:\s*["\']?([^"\']*)')
+        ],
+        "predicted_treatment_effect": [
+            ('"predicted_treatment_effect"', r'"predicted_treatment_effect"\s*:\s*"([^"]*)"'),
+            ('treatment', r'treatment.effect["\']?\s*:\s*["\']?([^"\']*)')
+        ]
+    }.items()
+}
+
+# 模型返回空响应时各字段的取值
+_EMPTY_PREDICTION = dict.fromkeys(_FIELD_PATTERNS, "ERROR: Empty response")
+
+class OllamaJSONLProcessor(OllamaSessionProcessor):
+    def __init__(self, base_url: str = "http://localhost:11434", model: str = "llama2",
+                 concurrency: int = OLLAMA_NUM_PARALLEL, batch_size: int = 16,
+                 rps: Optional[float] = None):
         """
         初始化Ollama处理器
-        """
-        self.base_url = base_url
-        self.model = model
-        self.generate_url = f"{base_url}/api/generate"
         
-        # 设置日志
-        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-        self.logger = logging.getLogger(__name__)
-    
-    def check_ollama_connection(self) -> bool:
-        """检查Ollama连接是否正常"""
-        try:
-            response = requests.get(f"{self.base_url}/api/tags", timeout=10)
-            return response.status_code == 200
-        except Exception as e:
-            self.logger.error(f"连接Ollama失败: {e}")
-            return False
+        Args:
+            base_url: Ollama服务器URL
+            model: 模型名称
+            concurrency: 同时发往Ollama的最大请求数
+            batch_size: 每批处理的用例数
+            rps: 每秒最多发起的请求数，None表示不限速
+        """
+        # 连接数需覆盖同时在途的请求
+        super().__init__(base_url, model, pool_size=concurrency)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.rps = rps
+        self._rate_limiter = RequestRateLimiter(rps)
+        self.processed_count = 0
+        self.error_count = 0
+        self.skipped_count = 0
+        # 信号量绑定事件循环，由 _ollama_session 按需创建
+        self._semaphore = None
+        self._session_users = 0
     
-    def generate_response(self, prompt: str, max_retries: int = 3) -> str:
+    async def agenerate_response(self, prompt: str) -> str:
         """
-        使用Ollama生成回复
+        在工作线程中调用 generate_response，不阻塞事件循环
         """
-        payload = {
-            "model": self.model,
-            "prompt": prompt,
-            "stream": False
-        }
-        
-        for attempt in range(max_retries):
-            try:
-                response = requests.post(self.generate_url, json=payload, timeout=120)
-                response.raise_for_status()
-                
-                result = response.json()
-                return result.get("response", "").strip()
-                
-            except requests.exceptions.RequestException as e:
-                self.logger.warning(f"第 {attempt + 1} 次请求失败: {e}")
-                if attempt < max_retries - 1:
-                    time.sleep(2)
-                else:
-                    self.logger.error(f"所有重试均失败: {e}")
-                    return ""
-            except json.JSONDecodeError as e:
-                self.logger.error(f"JSON解析错误: {e}")
-                return ""
-        
-        return ""
+        return await asyncio.to_thread(self.generate_response, prompt)
     
     def extract_json_from_response(self, response_text: str) -> Dict[str, str]:
         """
         从模型回复中提取JSON格式内容
         """
         if not response_text:
-            return {
-                "predicted_cause": "ERROR: Empty response",
-                "predicted_symptoms": "ERROR: Empty response",
-                "predicted_treatment_process": "ERROR: Empty response",
-                "predicted_illness_Characteristics": "ERROR: Empty response",
-                "predicted_treatment_effect": "ERROR: Empty response"
-            }
+            return _EMPTY_PREDICTION.copy()
         
-        # 尝试直接解析JSON
-        try:
-            # 查找JSON代码块
-            json_match = re.search(r'```json\s*(.*?)\s*```', response_text, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(1)
-                return json.loads(json_str)
-            else:
-                # 如果没有代码块标记，尝试直接解析整个响应
-                return json.loads(response_text)
-        except json.JSONDecodeError:
-            # 如果JSON解析失败，尝试提取各个字段
-            self.logger.warning("JSON解析失败，尝试提取字段")
-            return self._extract_fields_manually(response_text)
+        # 从每个 '{' 处尝试直接解码JSON对象，代码块与裸JSON均适用
+        idx = response_text.find('{')
+        while idx != -1:
+            try:
+                data, _ = _JSON_DECODER.raw_decode(response_text, idx)
+                # 只接受包含预测字段的对象，避免外层JSON损坏时误取内层的嵌套对象
+                if isinstance(data, dict) and not data.keys().isdisjoint(_FIELD_PATTERNS):
+                    return data
+            except json.JSONDecodeError:
+                pass
+            idx = response_text.find('{', idx + 1)
+        
+        # 如果JSON解析失败，尝试提取各个字段
+        self.logger.warning("JSON解析失败，尝试提取字段")
+        return self._extract_fields_manually(response_text)
     
     def _extract_fields_manually(self, text: str) -> Dict[str, str]:
         """
         手动从文本中提取各个字段
         """
-        result = {
-            "predicted_cause": "",
-            "predicted_symptoms": "",
-            "predicted_treatment_process": "",
-            "predicted_illness_Characteristics": "",
-            "predicted_treatment_effect": ""
-        }
+        result = dict.fromkeys(_FIELD_PATTERNS, "")
         
         # 简单的关键词匹配提取
-        patterns = {
-            "predicted_cause": [r'"predicted_cause"\s*:\s*"([^"]*)"', r'causes?["\']?\s*:\s*["\']?([^"\']*)'],
-            "predicted_symptoms": [r'"predicted_symptoms"\s*:\s*"([^"]*)"', r'symptoms?["\']?\s*:\s*["\']?([^"\']*)'],
-            "predicted_treatment_process": [r'"predicted_treatment_process"\s*:\s*"([^"]*)"', r'treatment.process["\']?\s*:\s*["\']?([^"\']*)'],
-            "predicted_illness_Characteristics": [r'"predicted_illness_Characteristics"\s*:\s*"([^"]*)"', r'characteristics["\']?\s*:\s*["\']?([^"\']*)'],
-            "predicted_treatment_effect": [r'"predicted_treatment_effect"\s*:\s*"([^"]*)"', r'treatment.effect["\']?\s*:\s*["\']?([^"\']*)']
-        }
-        
-        for field, pattern_list in patterns.items():
-            for pattern in pattern_list:
-                match = re.search(pattern, text, re.IGNORECASE | re.DOTALL)
+        text_lower = text.lower()
+        for field, pattern_list in _FIELD_PATTERNS.items():
+            for keyword, pattern in pattern_list:
+                if keyword not in text_lower:
+                    continue
+                match = pattern.search(text)
                 if match:
                     result[field] = match.group(1).strip()
                     break
@@ -122,52 +156,25 @@ class OllamaJSONLProcessor:
         """
         构建完整的提示词
         """
-        # 提取数据字段
-        case_description = case_data.get("case_description", [])
-        consultation_process = case_data.get("consultation_process", [])
-        experience_and_reflection = case_data.get("experience_and_reflection", "")
-        
-        # 将列表转换为字符串
-        case_desc_str = " ".join(case_description) if isinstance(case_description, list) else str(case_description)
-        consultation_str = " ".join(consultation_process) if isinstance(consultation_process, list) else str(consultation_process)
-        
-        # 构建完整提示词
-        prompt = f"""你是一名心理咨询专家。请基于以下心理咨询报告内容进行分析：
-
-案例描述: {case_desc_str}
-咨询过程: {consultation_str}
-经验与反思: {experience_and_reflection}
-
-请根据提供的内容总结以下信息：
-- 原因：个体心理问题的潜在或直接原因
-- 症状：个体表现出的自我报告或可观察的生理、心理或行为症状
-- 治疗过程：在咨询过程中应用的心理治疗方法、技术和阶段性干预
-- 疾病特征：心理问题的关键特征或发展模式
-- 治疗效果：治疗的影响或结果，包括个体状况的变化
-
-请严格按照以下JSON格式提供你的分析，不要添加任何其他文本：
-{{
-    "predicted_cause": "...",
-    "predicted_symptoms": "...", 
-    "predicted_treatment_process": "...",
-    "predicted_illness_Characteristics": "...",
-    "predicted_treatment_effect": "..."
-}}"""
-        
-        return prompt
+        # 提取数据字段并将列表转换为字符串，构建完整提示词
+        return _PROMPT_TEMPLATE.format(
+            case_desc_str=_join_text(case_data.get("case_description", [])),
+            consultation_str=_join_text(case_data.get("consultation_process", [])),
+            experience_and_reflection=case_data.get("experience_and_reflection", "")
+        )
     
-    def process_single_case(self, case_data: Dict[str, Any]) -> Dict[str, Any]:
+    async def process_single_case(self, case_data: Dict[str, Any]) -> Dict[str, Any]:
         """
         处理单个测试用例
         """
-        case_id = case_data.get("id", "unknown")
-        self.logger.info(f"处理用例 ID: {case_id}")
+        case_id = _case_id(case_data)
+        self.logger.debug("处理用例 ID: %s", case_id)
         
         # 构建提示词
         prompt = self.build_prompt(case_data)
         
         # 获取模型回复
-        response = self.generate_response(prompt)
+        response = await self.agenerate_response(prompt)
         
         # 提取JSON内容
         extracted_data = self.extract_json_from_response(response)
@@ -184,34 +191,115 @@ class OllamaJSONLProcessor:
         
         return result
     
-    def process_jsonl_file(self, input_file: str, output_file: str, max_lines: int = None):
+    async def process_batch(self, cases: List[Dict[str, Any]]) -> List[Any]:
+        """
+        并发处理一批测试用例，信号量限制同时在途的请求数
+        
+        Returns:
+            与输入顺序一致的结果列表，处理失败的用例对应位置为异常对象
+        """
+        async with self._ollama_session():
+            return await asyncio.gather(*(self._process_case(case_data) for case_data in cases), return_exceptions=True)
+    
+    @asynccontextmanager
+    async def _ollama_session(self):
+        """
+        在当前事件循环中准备信号量
+        
+        嵌套或并发调用共用同一个信号量，最后一个使用者退出时释放，下次运行重新创建。
+        """
+        if self._session_users == 0:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._session_users += 1
+        try:
+            yield
+        finally:
+            self._session_users -= 1
+            if self._session_users == 0:
+                self._semaphore = None
+    
+    async def _process_case(self, case_data: Dict[str, Any]) -> Dict[str, Any]:
+        async with self._semaphore:
+            await self._rate_limiter.wait()
+            return await self.process_single_case(case_data)
+    
+    def process_jsonl_file(self, input_file: str, output_file: str, max_lines: int = None, resume: bool = False):
         """
         处理整个JSONL文件
         
+        最多 concurrency 个请求同时发往服务端，服务端需设置 OLLAMA_NUM_PARALLEL 不小于该值。
+        
         Args:
             input_file: 输入JSONL文件路径
             output_file: 输出JSONL文件路径
             max_lines: 最大处理行数，None表示处理所有行
+            resume: 是否从中断处续跑：跳过输出文件中已有ID的用例，新结果追加到文件末尾
         """
         # 检查连接
         if not self.check_ollama_connection():
             self.logger.error("无法连接到Ollama服务，请检查服务是否启动")
             return
         
-        self.logger.info(f"开始处理文件: {input_file}")
-        self.logger.info(f"使用模型: {self.model}")
+        self.logger.info("开始处理文件: %s", input_file)
+        self.logger.info("使用模型: %s", self.model)
+        self.logger.info("并发请求数: %d", self.concurrency)
+        self.logger.info("批大小: %d", self.batch_size)
+        if self.rps:
+            self.logger.info("请求速率上限: %s 次/秒", self.rps)
         if max_lines:
-            self.logger.info(f"最大处理行数: {max_lines}")
+            self.logger.info("最大处理行数: %d", max_lines)
         
-        processed_count = 0
-        error_count = 0
+        done_ids = self._load_completed_ids(output_file) if resume else set()
+        if done_ids:
+            self.logger.info("续跑模式: 输出文件中已有 %d 个已完成用例", len(done_ids))
         
-        with open(input_file, 'r', encoding='utf-8') as infile, \
-             open(output_file, 'w', encoding='utf-8') as outfile:
+        asyncio.run(self._process_lines(input_file, output_file, max_lines, done_ids))
+    
+    def _load_completed_ids(self, output_file: str) -> Set[Any]:
+        """
+        读取已有输出文件中已完成用例的ID；
+        中断时未写完的末尾半行会被截断，避免与新追加的结果粘连
+        """
+        done_ids = set()
+        if not os.path.exists(output_file):
+            return done_ids
+        
+        with open(output_file, 'r+b') as f:
+            complete_size = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                complete_size += len(line)
+                try:
+                    done_ids.add(orjson.loads(line)["id"])
+                except (orjson.JSONDecodeError, KeyError, TypeError):
+                    continue
+            f.truncate(complete_size)
+        
+        return done_ids
+    
+    async def _process_lines(self, input_file: str, output_file: str, max_lines: int = None,
+                             done_ids: Set[Any] = frozenset()):
+        """
+        每 batch_size 个用例为一批，批内并发处理，按输入顺序写入结果；
+        ID已在 done_ids 中的用例直接跳过
+        """
+        # 阻塞的HTTP请求在线程池中执行；默认线程池大小取决于CPU核数，可能小于并发数，
+        # 因此按并发数创建，asyncio.run 结束时自动关闭
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=self.concurrency))
+        self._rate_limiter.reset()
+        self.processed_count = 0
+        self.error_count = 0
+        self.skipped_count = 0
+        
+        # 续跑时追加写入，保留已完成的结果
+        with open(input_file, 'rb') as infile, \
+             open(output_file, 'ab' if done_ids else 'wb') as outfile:
             
+            batch = []
             for line_num, line in enumerate(infile, 1):
                 if max_lines and line_num > max_lines:
-                    self.logger.info(f"达到最大行数限制 {max_lines}，停止处理")
+                    self.logger.info("达到最大行数限制 %d，停止处理", max_lines)
                     break
                     
                 line = line.strip()
@@ -220,29 +308,61 @@ class OllamaJSONLProcessor:
                 
                 try:
                     # 解析JSON
-                    case_data = json.loads(line)
-                    
-                    # 处理单个用例
-                    result = self.process_single_case(case_data)
-                    
-                    # 写入结果（严格符合要求格式）
-                    outfile.write(json.dumps(result, ensure_ascii=False) + '\n')
-                    outfile.flush()
-                    
-                    processed_count += 1
-                    self.logger.info(f"成功处理第 {line_num} 行，ID: {case_data.get('id', 'unknown')}")
-                    
-                    # 添加延迟避免过载
-                    time.sleep(1)
-                    
-                except json.JSONDecodeError as e:
-                    self.logger.error(f"第 {line_num} 行JSON解析错误: {e}")
-                    error_count += 1
-                except Exception as e:
-                    self.logger.error(f"处理第 {line_num} 行时发生错误: {e}")
-                    error_count += 1
+                    case_data = orjson.loads(line)
+                except orjson.JSONDecodeError as e:
+                    self.logger.error("第 %d 行JSON解析错误: %s", line_num, e)
+                    self.error_count += 1
+                    continue
+                
+                if not isinstance(case_data, dict):
+                    self.logger.error("第 %d 行不是JSON对象，已跳过", line_num)
+                    self.error_count += 1
+                    continue
+                
+                # 续跑时跳过已完成的用例；列表/对象形式的ID不可哈希，也不可能已完成
+                case_id = _case_id(case_data)
+                if done_ids and not isinstance(case_id, (dict, list)) and case_id in done_ids:
+                    self.skipped_count += 1
+                    continue
+                
+                # 凑满一批即提交
+                batch.append((line_num, case_data))
+                if len(batch) == self.batch_size:
+                    await self._process_batch_lines(batch, outfile)
+                    batch = []
+            
+            if batch:
+                await self._process_batch_lines(batch, outfile)
+        
+        self.logger.info("处理完成! 成功: %d, 失败: %d, 跳过已完成: %d",
+                         self.processed_count, self.error_count, self.skipped_count)
+    
+    async def _process_batch_lines(self, batch: List[Tuple[int, Dict[str, Any]]], outfile: BinaryIO):
+        """
+        处理一批用例并按原始顺序写入结果，记录整批耗时
+        """
+        batch_start = time.perf_counter()
+        results = await self.process_batch([case_data for _, case_data in batch])
+        output_lines = []
+        
+        for (line_num, _), result in zip(batch, results):
+            if isinstance(result, Exception):
+                self.logger.error("处理第 %d 行时发生错误: %s", line_num, result)
+                self.error_count += 1
+                continue
+            
+            output_lines.append(orjson.dumps(result) + b'\n')
+            
+            self.processed_count += 1
+            self.logger.debug("成功处理第 %d 行，ID: %s", line_num, result['id'])
+            if self.processed_count % PROGRESS_EVERY == 0:
+                self.logger.info("已成功处理 %d 个用例", self.processed_count)
         
-        self.logger.info(f"处理完成! 成功: {processed_count}, 失败: {error_count}")
+        # 整批结果合并为一次写入（严格符合要求格式）
+        outfile.write(b''.join(output_lines))
+        outfile.flush()
+        
+        self.logger.info("批次完成: %d 个用例，用时 %.2f 秒", len(batch), time.perf_counter() - batch_start)
 
 def main():
     """主函数"""
@@ -254,23 +374,35 @@ def main():
     parser.add_argument('--output', '-o', required=True, help='输出JSONL文件路径')
     parser.add_argument('--model', '-m', default='llama2', help='Ollama模型名称 (默认: llama2)')
     parser.add_argument('--url', '-u', default='http://localhost:11434', help='Ollama服务器URL')
+    parser.add_argument('--concurrency', '-c', type=int, default=OLLAMA_NUM_PARALLEL,
+                        help=f'同时在途的请求数，应与服务端 OLLAMA_NUM_PARALLEL 一致 (默认: {OLLAMA_NUM_PARALLEL})')
+    parser.add_argument('--batch-size', '-b', type=int, default=16, help='每批处理的用例数 (默认: 16)')
+    parser.add_argument('--rps', type=float, default=None, help='每秒最多发起的请求数 (默认: 不限速)')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='日志级别，DEBUG时输出逐行处理日志 (默认: INFO)')
+    parser.add_argument('--resume', '-r', action='store_true', help='从中断处续跑：跳过输出文件中已完成的用例并追加写入；'
+                        '没有ID的用例无法逐个续跑，只要有一个已完成就全部跳过')
     parser.add_argument('--test', '-t', action='store_true', help='测试模式：只处理前3条数据')
     
     args = parser.parse_args()
     
     # 初始化处理器
-    processor = OllamaJSONLProcessor(
+    with OllamaJSONLProcessor(
         base_url=args.url,
-        model=args.model
-    )
-    
-    # 处理文件
-    if args.test:
-        print("测试模式：只处理前3条数据")
-        processor.process_jsonl_file(args.input, args.output, max_lines=3)
-    else:
-        print("完整模式：处理所有数据")
-        processor.process_jsonl_file(args.input, args.output)
+        model=args.model,
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+        rps=args.rps
+    ) as processor:
+        processor.logger.setLevel(args.log_level)
+        
+        # 处理文件
+        if args.test:
+            print("测试模式：只处理前3条数据")
+            processor.process_jsonl_file(args.input, args.output, max_lines=3, resume=args.resume)
+        else:
+            print("完整模式：处理所有数据")
+            processor.process_jsonl_file(args.input, args.output, resume=args.resume)
     
     print(f"\n处理完成！结果保存在: {args.output}")
     
@@ -1,22 +1,42 @@
-import json
-import ollama
-import time
+import orjson
 import os
 import re
-from typing import List, Dict, Any
+from typing import BinaryIO, Dict, Any, Optional
+from base import OLLAMA_NUM_PARALLEL, BaseOllamaProcessor
 
-class OllamaLiteratureProcessor:
-    def __init__(self, model_name: str, base_prompt: str):
+# 以常见的是非疑问词开头，或包含明确的yes/no指示
+_YES_NO_RE = re.compile(
+    r'^\s*(?:is|are|does|do|did|was|were|has|have|had|can|could|will|would|should|must|may|might)\s'
+    r'| (?:yes or no|true or false|correct or incorrect)',
+    re.IGNORECASE
+)
+
+# 根据问题类型附加的作答要求
+_YES_NO_INSTRUCTION = "Answer with exactly one word: 'yes' or 'no'. Do not include any other text or explanation."
+_OPEN_INSTRUCTION = "Answer concisely in one sentence. Do not provide any explanation or additional context."
+
+class OllamaLiteratureProcessor(BaseOllamaProcessor):
+    answer_field = "predicted_answer"
+    
+    def __init__(self, model_name: str, base_prompt: str, batch_size: int = 16,
+                 concurrency: int = OLLAMA_NUM_PARALLEL, rps: Optional[float] = None):
         """
         初始化处理器
         
         Args:
             model_name: Ollama中的模型名称
             base_prompt: 整体的基础提示词
+            batch_size: 每批处理的样例数
+            concurrency: 同时发往Ollama的最大请求数
+            rps: 每秒最多发起的请求数，None表示不限速
         """
-        self.model_name = model_name
-        self.base_prompt = base_prompt
-        self.results = []
+        super().__init__(model_name, base_prompt, batch_size, concurrency, rps)
+        
+        # 提示词中与样例无关的开头部分只拼接一次
+        self._prompt_header = f"\n{base_prompt}\n\nArticle: "
+        
+        # yes/no问题数与其他统计一样随结果增量更新
+        self._n_yes_no = 0
     
     def is_yes_no_question(self, question: str) -> bool:
         """
@@ -28,28 +48,7 @@ class OllamaLiteratureProcessor:
         Returns:
             如果是yes/no问题返回True，否则返回False
         """
-        # 匹配常见的是非疑问词开头的问题
-        yes_no_patterns = [
-            r'^is\s+', r'^are\s+', r'^does\s+', r'^do\s+', r'^did\s+', 
-            r'^was\s+', r'^were\s+', r'^has\s+', r'^have\s+', r'^had\s+',
-            r'^can\s+', r'^could\s+', r'^will\s+', r'^would\s+', r'^should\s+',
-            r'^must\s+', r'^may\s+', r'^might\s+'
-        ]
-        
-        question_lower = question.strip().lower()
-        
-        # 检查是否以疑问词开头
-        for pattern in yes_no_patterns:
-            if re.match(pattern, question_lower):
-                return True
-        
-        # 检查是否包含明确的yes/no指示
-        if any(phrase in question_lower for phrase in [
-            ' yes or no', ' true or false', ' correct or incorrect'
-        ]):
-            return True
-            
-        return False
+        return _YES_NO_RE.search(question) is not None
     
     def clean_response(self, response: str, is_yes_no: bool) -> str:
         """
@@ -68,189 +67,98 @@ class OllamaLiteratureProcessor:
             # 对于yes/no问题，只保留yes或no
             response_lower = response.lower()
             
-            # 匹配yes/no及其变体
-            if re.match(r'^\s*yes\s*$', response_lower, re.IGNORECASE):
-                return "yes"
-            elif re.match(r'^\s*no\s*$', response_lower, re.IGNORECASE):
-                return "no"
-            else:
-                # 如果响应不是纯yes/no，尝试提取第一个单词
-                first_word = response.split()[0].lower() if response.split() else ""
-                if first_word in ['yes', 'no']:
-                    return first_word
-                else:
-                    # 如果无法提取，返回原始响应的前几个字符（限制长度）
-                    return response[:50]  # 限制长度避免过长输出
+            # 响应已去除首尾空白，纯yes/no直接比较即可
+            if response_lower == "yes" or response_lower == "no":
+                return response_lower
+            
+            # 如果响应不是纯yes/no，尝试提取第一个单词
+            words = response_lower.split(None, 1)
+            first_word = words[0] if words else ""
+            if first_word in ('yes', 'no'):
+                return first_word
+            
+            # 如果无法提取，返回原始响应的前几个字符（限制长度）
+            return response[:50]  # 限制长度避免过长输出
         
         # 对于非yes/no问题，返回原样但限制长度
         return response[:200]  # 限制长度避免过长输出
     
-    def process_single_example(self, example: Dict[str, Any]) -> Dict[str, Any]:
+    def build_prompt(self, example: Dict[str, Any], is_yes_no: Optional[bool] = None) -> str:
         """
-        处理单个测试样例
+        构建完整的提示词 - 使用更严格的提示词
         
         Args:
             example: 单个测试样例的字典
-            
-        Returns:
-            包含ID和预测答案的字典
+            is_yes_no: 是否为yes/no问题，None表示根据问题判断
         """
-        # 构建完整的提示词 - 使用更严格的提示词
         context = example.get("context", "")
         problem = example.get("problem", "")
-        
-        # 判断是否为yes/no问题
-        is_yes_no = self.is_yes_no_question(problem)
+        if is_yes_no is None:
+            is_yes_no = self.is_yes_no_question(problem)
         
         # 根据问题类型构建不同的提示词
-        if is_yes_no:
-            answer_instruction = "Answer with exactly one word: 'yes' or 'no'. Do not include any other text or explanation."
-        else:
-            answer_instruction = "Answer concisely in one sentence. Do not provide any explanation or additional context."
-        
-        full_prompt = f"""
-{self.base_prompt}
-
-Article: {context}
-
-Question: {problem}
-
-{answer_instruction}
-Answer:
-"""
-        
-        try:
-            # 调用Ollama模型
-            response = ollama.generate(
-                model=self.model_name,
-                prompt=full_prompt
-            )
-            
-            # 提取模型回答并清理
-            model_response = response['response'].strip()
-            cleaned_response = self.clean_response(model_response, is_yes_no)
-            
-            # 构建结果 - 仅包含ID和预测答案
-            result = {
-                "id": example.get("id", 0),
-                "predicted_answer": cleaned_response,
-                "is_yes_no_question": is_yes_no,
-                "original_response": model_response  # 保留原始响应用于调试
-            }
-            
-            return result
-            
-        except Exception as e:
-            print(f"处理样例 {example.get('id')} 时出错: {str(e)}")
-            return {
-                "id": example.get("id", 0),
-                "predicted_answer": f"Error: {str(e)}",
-                "is_yes_no_question": False,
-                "original_response": ""
-            }
+        answer_instruction = _YES_NO_INSTRUCTION if is_yes_no else _OPEN_INSTRUCTION
+        
+        return (
+            f"{self._prompt_header}{context}\n\n"
+            f"Question: {problem}\n\n"
+            f"{answer_instruction}\n"
+            f"Answer:\n"
+        )
     
-    def process_jsonl_file(self, input_file: str, output_file: str = None, delay: float = 1.0, max_examples: int = None):
-        """
-        处理整个JSONL文件
-        
-        Args:
-            input_file: 输入JSONL文件路径
-            output_file: 输出结果文件路径（可选）
-            delay: 每次API调用之间的延迟（秒）
-            max_examples: 最大处理样例数（可选）
-        """
-        # 检查输入文件是否存在
-        if not os.path.exists(input_file):
-            print(f"错误：找不到输入文件 {input_file}")
-            print("请检查文件路径是否正确")
-            return
-        
-        print(f"开始处理文件: {input_file}")
-        print(f"使用模型: {self.model_name}")
-        
-        # 读取JSONL文件
-        with open(input_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        
-        # 限制处理数量
-        if max_examples:
-            lines = lines[:max_examples]
-            print(f"测试模式: 只处理前 {max_examples} 个样例")
-        
-        total_examples = len(lines)
-        print(f"找到 {total_examples} 个测试样例")
-        
-        # 处理每个样例
-        for i, line in enumerate(lines):
-            try:
-                example = json.loads(line.strip())
-                # 如果没有ID字段，使用索引作为ID
-                if "id" not in example:
-                    example["id"] = i
-                
-                print(f"处理样例 {i+1}/{total_examples} (ID: {example.get('id')})...")
-                
-                result = self.process_single_example(example)
-                self.results.append(result)
-                
-                # 显示进度和结果
-                is_yes_no = result.get("is_yes_no_question", False)
-                answer_type = "yes/no" if is_yes_no else "open"
-                print(f"✓ 完成样例 {example.get('id')} ({answer_type}): {result.get('predicted_answer')}")
-                
-                # 添加延迟以避免过快的API调用
-                if i < total_examples - 1:  # 不在最后一个样例后等待
-                    time.sleep(delay)
-                    
-            except json.JSONDecodeError as e:
-                print(f"❌ 解析第 {i+1} 行JSON时出错: {str(e)}")
-                self.results.append({
-                    "id": i,
-                    "predicted_answer": f"JSON解析错误: {str(e)}",
-                    "is_yes_no_question": False,
-                    "original_response": ""
-                })
-            except Exception as e:
-                print(f"❌ 处理第 {i+1} 行时出错: {str(e)}")
-                self.results.append({
-                    "id": i,
-                    "predicted_answer": f"处理错误: {str(e)}",
-                    "is_yes_no_question": False,
-                    "original_response": ""
-                })
-        
-        # 保存结果
-        if output_file:
-            self.save_results(output_file)
-        
-        print(f"处理完成！共处理 {len(self.results)} 个样例")
+    def postprocess(self, example: Dict[str, Any], response: str) -> Dict[str, Any]:
+        """提取模型回答并清理"""
+        is_yes_no = self.is_yes_no_question(example.get("problem", ""))
+        model_response = response.strip()
+        cleaned_response = self.clean_response(model_response, is_yes_no)
+        
+        # 构建结果 - 仅包含ID和预测答案
+        return {
+            "id": example.get("id", 0),
+            "predicted_answer": cleaned_response,
+            "is_yes_no_question": is_yes_no,
+            "original_response": model_response  # 保留原始响应用于调试
+        }
+    
+    def error_result(self, example_id: Any, message: str) -> Dict[str, Any]:
+        """出错时也保持相同的输出格式"""
+        return {
+            "id": example_id,
+            "predicted_answer": message,
+            "is_yes_no_question": False,
+            "original_response": ""
+        }
+    
+    def format_progress(self, result: Dict[str, Any]) -> str:
+        """显示进度和结果"""
+        answer_type = "yes/no" if result.get("is_yes_no_question", False) else "open"
+        return f"✓ 完成样例 {result.get('id')} ({answer_type}): {result.get('predicted_answer')}"
     
-    def save_results(self, output_file: str):
-        """保存结果到文件"""
-        with open(output_file, 'w', encoding='utf-8') as f:
-            for result in self.results:
-                # 只保存必要字段到输出文件
-                output_result = {
-                    "id": result.get("id"),
-                    "predicted_answer": result.get("predicted_answer")
-                }
-                f.write(json.dumps(output_result, ensure_ascii=False) + '\n')
-        print(f"结果已保存到: {output_file}")
+    def _collect_result(self, result: Dict[str, Any], out: Optional[BinaryIO]):
+        """记录一条已完成的结果"""
+        if result.get("is_yes_no_question", False):
+            self._n_yes_no += 1
+        super()._collect_result(result, out)
+    
+    def save_result(self, out: BinaryIO, result: Dict[str, Any]):
+        """写入单条结果"""
+        # 只保存必要字段到输出文件
+        output_result = {
+            "id": result.get("id"),
+            "predicted_answer": result.get("predicted_answer")
+        }
+        out.write(orjson.dumps(output_result) + b'\n')
     
     def print_summary(self):
         """打印处理摘要"""
-        successful = len([r for r in self.results if not r.get("predicted_answer", "").startswith("Error")])
-        failed = len([r for r in self.results if r.get("predicted_answer", "").startswith("Error")])
-        yes_no_questions = len([r for r in self.results if r.get("is_yes_no_question", False)])
-        
         print("\n" + "="*50)
         print("处理摘要")
         print("="*50)
-        print(f"总样例数: {len(self.results)}")
-        print(f"成功: {successful}")
-        print(f"失败: {failed}")
-        print(f"yes/no问题: {yes_no_questions}")
-        print(f"开放性问题: {len(self.results) - yes_no_questions}")
+        print(f"总样例数: {self._n_total}")
+        print(f"成功: {self._n_total - self._n_failed}")
+        print(f"失败: {self._n_failed}")
+        print(f"yes/no问题: {self._n_yes_no}")
+        print(f"开放性问题: {self._n_total - self._n_yes_no}")
         print(f"使用模型: {self.model_name}")
 
 # 使用示例
@@ -290,7 +198,6 @@ Remember: Your response must be solely based on the information contained in the
     processor.process_jsonl_file(
         input_file=INPUT_FILE,
         output_file=OUTPUT_FILE,
-        delay=2.0,  # 每次调用间隔2秒
         max_examples=None  # 设置为None处理所有样例，设置为数字则处理前N个
     )
     
@@ -299,9 +206,10 @@ Remember: Your response must be solely based on the information contained in the
     
     # 显示所有结果
     print("\n所有结果:")
-    for i, result in enumerate(processor.results):
-        answer_type = "yes/no" if result.get("is_yes_no_question") else "open"
-        print(f"ID: {result.get('id')} ({answer_type}) -> 预测答案: {result.get('predicted_answer', 'N/A')}")
+    with open(OUTPUT_FILE, 'r', encoding='utf-8') as f:
+        for line in f:
+            result = orjson.loads(line)
+            print(f"ID: {result.get('id')} -> 预测答案: {result.get('predicted_answer', 'N/A')}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,376 @@
+"""
+各任务脚本共用的Ollama调用部分
+
+- OllamaSessionProcessor: 通过 requests 连接池调用 /api/generate，失败时退避重试（ED、ES）
+- BaseOllamaProcessor: 通过 ollama.AsyncClient 按批并发调用，子类只需构建提示词和后处理回答（MC、QA）
+- RequestRateLimiter: 按 rps 均匀错开请求的发起时间（ES、MC、QA）
+"""
+import asyncio
+import itertools
+import logging
+import ollama
+import orjson
+import os
+import random
+import requests
+from requests.adapters import HTTPAdapter
+import time
+from contextlib import asynccontextmanager, nullcontext
+from typing import BinaryIO, Iterable, List, Dict, Any, Optional
+
+# 同时在途的请求数，应与服务端的 OLLAMA_NUM_PARALLEL 并行槽位数保持一致
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4"))
+
+# 连接检查成功后的有效期（秒），期间重复处理文件无需再次探测服务
+_CONNECTION_CHECK_TTL = 30.0
+
+# 失败重试的退避基数与上限（秒）
+_RETRY_BASE_DELAY = 1.0
+_RETRY_MAX_DELAY = 30.0
+
+class RequestRateLimiter:
+    def __init__(self, rps: Optional[float] = None):
+        """
+        Args:
+            rps: 每秒最多发起的请求数，None表示不限速
+        """
+        self.rps = rps
+        self._next_request_time = 0.0
+    
+    def reset(self):
+        """新一次运行从头计时"""
+        self._next_request_time = 0.0
+    
+    async def wait(self):
+        """按 rps 均匀错开请求的发起时间，服务端响应快时无需额外等待"""
+        if not self.rps:
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next_request_time)
+        self._next_request_time = slot + 1.0 / self.rps
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+class OllamaSessionProcessor:
+    def __init__(self, base_url: str, model: str, pool_size: int):
+        """
+        初始化连接池和日志
+        
+        Args:
+            base_url: Ollama服务器URL
+            model: 模型名称
+            pool_size: 连接池大小，需覆盖同时在途的请求数
+        """
+        self.base_url = base_url
+        self.model = model
+        self.generate_url = f"{base_url}/api/generate"
+        
+        # 复用连接池，避免每次请求重新建立TCP连接
+        adapter = HTTPAdapter(pool_maxsize=max(pool_size, 10))
+        self._session = requests.Session()
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._connection_checked_at = None
+        
+        # 设置日志，日志名沿用子类所在模块
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+        self.logger = logging.getLogger(type(self).__module__)
+    
+    def close(self):
+        """释放连接池"""
+        self._session.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+    
+    def check_ollama_connection(self) -> bool:
+        """检查Ollama连接是否正常，成功结果在有效期内直接复用"""
+        now = time.monotonic()
+        if self._connection_checked_at is not None and now - self._connection_checked_at < _CONNECTION_CHECK_TTL:
+            return True
+        
+        try:
+            response = self._session.get(f"{self.base_url}/api/tags", timeout=10)
+        except Exception as e:
+            self.logger.error("连接Ollama失败: %s", e)
+            return False
+        
+        if response.status_code != 200:
+            return False
+        self._connection_checked_at = now
+        return True
+    
+    def generate_response(self, prompt: str, max_retries: int = 3) -> str:
+        """
+        使用Ollama生成回复
+        """
+        payload = {
+            "model": self.model,
+            "prompt": prompt,
+            "stream": False
+        }
+        
+        for attempt in range(max_retries):
+            response = None
+            try:
+                response = self._session.post(self.generate_url, json=payload, timeout=120)
+                if response.status_code == 200:
+                    return orjson.loads(response.content).get("response", "").strip()
+                self.logger.warning("第 %d 次请求失败: HTTP %d", attempt + 1, response.status_code)
+            
+            except requests.exceptions.RequestException as e:
+                self.logger.warning("第 %d 次请求失败: %s", attempt + 1, e)
+            except orjson.JSONDecodeError as e:
+                self.logger.error("JSON解析错误: %s", e)
+                return ""
+            
+            if attempt < max_retries - 1:
+                time.sleep(self._retry_delay(attempt, response))
+        
+        self.logger.error("所有重试均失败")
+        return ""
+    
+    @staticmethod
+    def _retry_delay(attempt: int, response: Optional[requests.Response] = None) -> float:
+        """
+        重试前的等待时间：服务端过载(429/503)并给出 Retry-After 时照办，
+        否则指数退避并加全抖动，避免并发请求同时失败后又同时重试
+        """
+        if response is not None and response.status_code in (429, 503):
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                return min(float(retry_after), _RETRY_MAX_DELAY)
+        return random.uniform(0, min(_RETRY_MAX_DELAY, _RETRY_BASE_DELAY * 2 ** attempt))
+
+class BaseOllamaProcessor:
+    # 结果中保存模型回答的字段名
+    answer_field = "predicted_answer"
+    
+    def __init__(self, model_name: str, base_prompt: str, batch_size: int = 16,
+                 concurrency: int = OLLAMA_NUM_PARALLEL, rps: Optional[float] = None):
+        """
+        初始化处理器
+        
+        Args:
+            model_name: Ollama中的模型名称
+            base_prompt: 整体的基础提示词
+            batch_size: 每批处理的样例数
+            concurrency: 同时发往Ollama的最大请求数
+            rps: 每秒最多发起的请求数，None表示不限速
+        """
+        self.model_name = model_name
+        self.base_prompt = base_prompt
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.rps = rps
+        self._rate_limiter = RequestRateLimiter(rps)
+        
+        # 摘要统计随结果增量更新，无需保留全部结果
+        self._n_total = 0
+        self._n_failed = 0
+        # 信号量和客户端绑定事件循环，由 _ollama_session 按需创建
+        self._semaphore = None
+        self._client = None
+        self._session_users = 0
+    
+    def build_prompt(self, example: Dict[str, Any]) -> str:
+        """构建单个样例的完整提示词"""
+        raise NotImplementedError
+    
+    def postprocess(self, example: Dict[str, Any], response: str) -> Dict[str, Any]:
+        """由模型回答构建单个样例的结果"""
+        raise NotImplementedError
+    
+    def error_result(self, example_id: Any, message: str) -> Dict[str, Any]:
+        """出错时也保持相同的输出格式"""
+        return {
+            "id": example_id,
+            self.answer_field: message
+        }
+    
+    def format_progress(self, result: Dict[str, Any]) -> str:
+        """单个样例完成后显示的进度"""
+        return f"✓ 完成样例 {result.get('id')}"
+    
+    @asynccontextmanager
+    async def _ollama_session(self):
+        """
+        在当前事件循环中准备客户端和信号量
+        
+        嵌套或并发调用共用同一组对象，最后一个使用者退出时关闭客户端，下次运行重新创建。
+        """
+        if self._session_users == 0:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._client = ollama.AsyncClient()
+        self._session_users += 1
+        try:
+            yield
+        finally:
+            self._session_users -= 1
+            if self._session_users == 0:
+                client, self._client, self._semaphore = self._client, None, None
+                await client.close()
+    
+    async def _generate(self, prompt: str) -> str:
+        """调用Ollama模型，信号量限制同时在途的请求数"""
+        async with self._semaphore:
+            await self._rate_limiter.wait()
+            response = await self._client.generate(
+                model=self.model_name,
+                prompt=prompt
+            )
+        return response['response']
+    
+    async def process_batch(self, examples: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        并发处理一批测试样例：先构建全部提示词，再同时提交；构建失败的样例不提交
+        
+        Args:
+            examples: 测试样例字典列表
+        
+        Returns:
+            与输入顺序一致的结果列表
+        """
+        # 逐个构建提示词，单个样例出错不影响同批其他样例
+        prompts = []
+        for example in examples:
+            try:
+                prompts.append(self.build_prompt(example))
+            except Exception as e:
+                print(f"❌ 处理样例 {example.get('id')} 时出错: {str(e)}")
+                prompts.append(e)
+        
+        # 单独调用时也能使用；在 _process_lines 中调用时复用整次运行的客户端
+        async with self._ollama_session():
+            responses = iter(await asyncio.gather(
+                *(self._generate(prompt) for prompt in prompts if not isinstance(prompt, Exception)),
+                return_exceptions=True
+            ))
+        
+        results = []
+        for example, prompt in zip(examples, prompts):
+            if isinstance(prompt, Exception):
+                results.append(self.error_result(example.get("id"), f"处理错误: {str(prompt)}"))
+                continue
+            
+            response = next(responses)
+            if isinstance(response, Exception):
+                print(f"处理样例 {example.get('id')} 时出错: {str(response)}")
+                results.append(self.error_result(example.get("id"), f"Error: {str(response)}"))
+                continue
+            
+            results.append(self.postprocess(example, response))
+        
+        return results
+    
+    def process_jsonl_file(self, input_file: str, output_file: str = None, max_examples: int = None):
+        """
+        处理整个JSONL文件
+        
+        Args:
+            input_file: 输入JSONL文件路径
+            output_file: 输出结果文件路径（可选）
+            max_examples: 最大处理样例数（可选）
+        """
+        # 检查输入文件是否存在
+        if not os.path.exists(input_file):
+            print(f"错误：找不到输入文件 {input_file}")
+            print("请检查文件路径是否正确")
+            return
+        
+        print(f"开始处理文件: {input_file}")
+        print(f"使用模型: {self.model_name}")
+        
+        if max_examples:
+            print(f"测试模式: 只处理前 {max_examples} 个样例")
+        
+        # 逐行读取JSONL文件，无需先把整个文件载入内存；
+        # 每完成一批立即写入输出文件，中途中断也不会丢失已完成的结果
+        with open(input_file, 'rb') as f, \
+             (open(output_file, 'wb') if output_file else nullcontext()) as out:
+            lines = itertools.islice(f, max_examples) if max_examples else f
+            asyncio.run(self._process_lines(lines, out))
+        
+        if output_file:
+            print(f"结果已保存到: {output_file}")
+            self.preview_results(output_file)
+        
+        print(f"处理完成！共处理 {self._n_total} 个样例")
+    
+    async def _process_lines(self, lines: Iterable[bytes], out: Optional[BinaryIO]):
+        """
+        每 batch_size 行为一批，批内并发处理，结果按输入顺序计入统计并写入输出文件
+        """
+        self._rate_limiter.reset()
+        numbered_lines = enumerate(lines)
+        
+        # 整次运行共用一个客户端连接池
+        async with self._ollama_session():
+            while True:
+                chunk = list(itertools.islice(numbered_lines, self.batch_size))
+                if not chunk:
+                    break
+                
+                batch_start = time.perf_counter()
+                
+                # 每行对应 (样例, None) 或解析失败时的 (None, 错误结果)
+                entries = []
+                for i, line in chunk:
+                    try:
+                        example = orjson.loads(line)
+                        # 如果没有ID字段，使用索引作为ID
+                        if "id" not in example:
+                            example["id"] = i
+                        
+                        print(f"处理样例 {i+1} (ID: {example.get('id')})...")
+                        entries.append((example, None))
+                    except orjson.JSONDecodeError as e:
+                        print(f"❌ 解析第 {i+1} 行JSON时出错: {str(e)}")
+                        # 即使解析错误也创建一个结果条目
+                        entries.append((None, self.error_result(i, f"JSON解析错误: {str(e)}")))
+                    except Exception as e:
+                        print(f"❌ 处理第 {i+1} 行时出错: {str(e)}")
+                        entries.append((None, self.error_result(i, f"处理错误: {str(e)}")))
+                
+                batch_results = iter(await self.process_batch([example for example, _ in entries if example is not None]))
+                for example, error_result in entries:
+                    result = error_result if example is None else next(batch_results)
+                    self._collect_result(result, out)
+                    
+                    # 显示进度
+                    if example is not None:
+                        print(self.format_progress(result))
+                
+                if out is not None:
+                    out.flush()
+                
+                print(f"批次完成: {len(entries)} 个样例，用时 {time.perf_counter() - batch_start:.2f} 秒")
+    
+    def _collect_result(self, result: Dict[str, Any], out: Optional[BinaryIO]):
+        """记录一条已完成的结果"""
+        self._n_total += 1
+        if result.get(self.answer_field, "").startswith("Error"):
+            self._n_failed += 1
+        if out is not None:
+            self.save_result(out, result)
+    
+    def save_result(self, out: BinaryIO, result: Dict[str, Any]):
+        """写入单条结果"""
+        out.write(orjson.dumps(result) + b'\n')
+    
+    def preview_results(self, output_file: str):
+        """处理完成后显示部分结果，默认不显示"""
+    
+    def print_summary(self):
+        """打印处理摘要"""
+        print("\n" + "="*50)
+        print("处理摘要")
+        print("="*50)
+        print(f"总样例数: {self._n_total}")
+        print(f"成功: {self._n_total - self._n_failed}")
+        print(f"失败: {self._n_failed}")
+        print(f"使用模型: {self.model_name}")